@@ -1,4 +1,11 @@
 # app.py
+import eventlet
+from eventlet import tpool
+# Keep real OS threads for the subprocess reader loop, and leave os and
+# select unpatched so the loop gets a real epoll selector and a raw
+# os.read that returns EAGAIN instead of trampolining into the hub
+eventlet.monkey_patch(thread=False, os=False, select=False)
+
 import os
 import sys
 import subprocess
@@ -7,24 +14,67 @@ import time
 import signal
 from flask import Flask, render_template, jsonify, request
 from flask_socketio import SocketIO, emit
-import select
+import selectors
 import psutil
-import queue
+import collections
+import concurrent.futures
 import logging
 from datetime import datetime
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
+# Set up logging; default INFO, override via LOG_LEVEL=DEBUG for debugging
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
 logger = logging.getLogger(__name__)
 
+# Fast JSON for the high-frequency terminal_output emits; socketio expects
+# dumps() to return str, while orjson returns bytes, hence the shim
+try:
+    import orjson
+
+    class _OrjsonShim:
+        @staticmethod
+        def dumps(obj, *args, **kwargs):
+            return orjson.dumps(obj).decode('utf-8')
+
+        @staticmethod
+        def loads(s, *args, **kwargs):
+            return orjson.loads(s)
+
+    socketio_json = _OrjsonShim
+except ImportError:
+    import json as socketio_json
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
-socketio = SocketIO(app, cors_allowed_origins="*", ping_timeout=5, ping_interval=2, logger=True, engineio_logger=True)
+socketio = SocketIO(app, async_mode='eventlet', cors_allowed_origins="*", ping_timeout=5, ping_interval=2, logger=False, engineio_logger=False, json=socketio_json)
 
 # Store terminal processes and their output
 terminals = {}
-terminal_outputs = {i: [] for i in range(1, 7)}
-output_queues = {i: queue.Queue() for i in range(1, 7)}
+# Cap each terminal's buffer by total bytes rather than line count, so a
+# few very long lines (e.g. ROS TF chains) can't hold megabytes
+OUTPUT_BUFFER_BYTES = 16384
+terminal_outputs = {i: collections.deque() for i in range(1, 7)}
+terminal_bytes = {i: 0 for i in range(1, 7)}
+# Last five lines per terminal, maintained alongside the main buffer so
+# replay endpoints never have to copy and slice the full deque
+terminal_tails = {i: collections.deque(maxlen=5) for i in range(1, 7)}
+
+# Single selector multiplexing the stdout pipes of all terminals
+output_selector = selectors.DefaultSelector()
+# Trailing partial line carried over between reads, per terminal
+output_residuals = {i: bytearray() for i in range(1, 7)}
+
+# Lines waiting to be flushed to clients in one batched emit per terminal
+pending_outputs = {i: [] for i in range(1, 7)}
+pending_lock = threading.Lock()
+
+# Number of connected SocketIO clients; the flusher skips emit work
+# (but the deques still fill for replay) when nobody is listening
+connected_clients = 0
+clients_lock = threading.Lock()
+
+# Small fixed pool for process launches and teardown, which can block
+# briefly on fork/exec, instead of spawning a fresh thread each time
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
 
 # ROS environment setup - this is critical for ROS commands to work
 ros_setup_commands = [
@@ -84,38 +134,112 @@ def create_shell_command(init_commands, main_command):
     else:
         return main_command
 
-# Function to read output from a process
-def read_process_output(process, terminal_id):
+# The commands are module constants, so build each full shell command once
+# at import instead of re-joining the setup commands on every start
+for cmd_info in terminal_commands.values():
+    cmd_info['full_cmd'] = create_shell_command(cmd_info.get('init'), cmd_info['start'])
+
+# Store one output line, evicting oldest lines once the byte cap is hit
+def store_output_line(terminal_id, line):
+    terminal_outputs[terminal_id].append(line)
+    terminal_bytes[terminal_id] += len(line)
+    while terminal_bytes[terminal_id] > OUTPUT_BUFFER_BYTES:
+        terminal_bytes[terminal_id] -= len(terminal_outputs[terminal_id].popleft())
+    terminal_tails[terminal_id].append(line)
+
+# Handle a block of output read from one terminal's stdout pipe
+def handle_output_data(terminal_id, data):
+    residual = output_residuals[terminal_id]
+    residual += data
+    if b'\n' not in residual:
+        return
+    # Keep the trailing partial line for the next read
+    complete, _, rest = bytes(residual).rpartition(b'\n')
+    output_residuals[terminal_id] = bytearray(rest)
+    for line in complete.split(b'\n'):
+        output_text = line.decode('utf-8', errors='ignore').strip()
+        if output_text:
+            # Store the output, bounded by the per-terminal byte cap
+            store_output_line(terminal_id, output_text)
+
+            # Queue for the batched flusher instead of emitting per line
+            with pending_lock:
+                pending_outputs[terminal_id].append(output_text)
+
+# Flush pending output to all connected clients in one emit per terminal
+def _flush_outputs():
     while True:
+        socketio.sleep(0.05)
         try:
-            if process.poll() is not None:
-                break
-                
-            # Use non-blocking read
-            try:
-                output = process.stdout.readline()
-                if output:
-                    output_text = output.decode('utf-8', errors='ignore').strip()
-                    if output_text:
-                        # Store the output
-                        terminal_outputs[terminal_id].append(output_text)
-                        # Keep only last 100 lines to prevent memory issues
-                        if len(terminal_outputs[terminal_id]) > 100:
-                            terminal_outputs[terminal_id] = terminal_outputs[terminal_id][-100:]
-                        
-                        # Send update to all connected clients via SocketIO
-                        socketio.emit('terminal_output', {
-                            'id': terminal_id,
-                            'output': output_text + '\n',
-                            'timestamp': datetime.now().isoformat()
-                        })
-            except Exception as e:
-                # Non-blocking read might raise an exception when no data is available
-                time.sleep(0.1)
-                
+            if connected_clients == 0:
+                # Nobody to deliver to; drop pending lines, the deques keep
+                # the tail for replay on the next connect
+                with pending_lock:
+                    for lines in pending_outputs.values():
+                        lines.clear()
+                continue
+            with pending_lock:
+                batches = {id: lines for id, lines in pending_outputs.items() if lines}
+                for id in batches:
+                    pending_outputs[id] = []
+            if not batches:
+                continue
+            # One timestamp per flush instead of one per line
+            timestamp = datetime.now().isoformat()
+            for id, lines in batches.items():
+                socketio.emit('terminal_output', {
+                    'id': id,
+                    'output': '\n'.join(lines) + '\n',
+                    'timestamp': timestamp
+                })
+        except Exception as e:
+            logger.error(f"Error flushing terminal output: {e}")
+
+# Unregister a terminal's stdout from the selector and close it, so a
+# stop or restart never leaves a stale fd registered
+def release_terminal_pipe(id):
+    process = terminals.get(id, {}).get('process')
+    if process is None or process.stdout is None or process.stdout.closed:
+        return
+    try:
+        output_selector.unregister(process.stdout.fileno())
+    except KeyError:
+        pass  # Already unregistered by the EOF path
+    try:
+        process.stdout.close()
+    except OSError:
+        pass
+
+# Single background loop multiplexing output from all terminal processes
+def _io_loop():
+    while True:
+        try:
+            for key, _ in output_selector.select(timeout=0.5):
+                terminal_id = key.data
+                try:
+                    data = os.read(key.fd, 65536)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    data = b''
+                if data:
+                    handle_output_data(terminal_id, data)
+                else:
+                    # EOF: the child exited and closed its end of the pipe
+                    try:
+                        output_selector.unregister(key.fd)
+                    except KeyError:
+                        pass  # Already released by a stop or restart
+                    # Only mark the terminal dead if this fd still belongs
+                    # to its current process; a late EOF from a replaced
+                    # pipe must not touch the restarted terminal's state
+                    process = terminals.get(terminal_id, {}).get('process')
+                    if (process is not None and process.stdout is not None
+                            and not process.stdout.closed
+                            and process.stdout.fileno() == key.fd):
+                        terminals[terminal_id]['running'] = False
         except Exception as e:
-            logger.error(f"Error reading output from terminal {terminal_id}: {e}")
-            break
+            logger.error(f"Error in terminal output loop: {e}")
 
 # Function to start a specific terminal process
 def start_terminal(id):
@@ -125,16 +249,15 @@ def start_terminal(id):
         time.sleep(1)
     
     try:
-        # Get the command info
-        cmd_info = terminal_commands[id]
-        
-        # Create the full command with environment setup
-        if 'init' in cmd_info:
-            full_cmd = create_shell_command(cmd_info['init'], cmd_info['start'])
-        else:
-            full_cmd = cmd_info['start']
-        
-        logger.debug(f"Starting terminal {id} with command: {full_cmd}")
+        # Release the previous process's pipe (a dead child may not have
+        # hit the EOF path yet) before its Popen is replaced below
+        release_terminal_pipe(id)
+
+        # Get the pre-built command with environment setup
+        full_cmd = terminal_commands[id]['full_cmd']
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Starting terminal {id} with command: {full_cmd}")
         
         # Create a process with the start command
         process = subprocess.Popen(
@@ -142,32 +265,37 @@ def start_terminal(id):
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
             stdin=subprocess.PIPE,
-            preexec_fn=os.setsid,  # Create new process group for proper signal handling
-            bufsize=1,  # Line buffered
-            universal_newlines=True  # Text mode
+            start_new_session=True,  # New process group for proper signal handling
+            bufsize=0  # Unbuffered binary pipe, read raw via os.read
         )
-        
+
+        # Non-blocking so os.read never stalls the shared reader loop
+        os.set_blocking(process.stdout.fileno(), False)
+        output_residuals[id] = bytearray()
+
         # Store the process
         terminals[id] = {
             'process': process,
+            # With start_new_session the child leads its own group, so
+            # its pgid is simply its pid - no need to query it on stop
+            'pgid': process.pid,
             'running': True,
             'start_time': datetime.now()
         }
-        
-        # Start a thread to read the output
-        threading.Thread(target=read_process_output, args=(process, id), daemon=True).start()
-        
+
+        # Register the stdout pipe with the shared output selector
+        output_selector.register(process.stdout.fileno(), selectors.EVENT_READ, data=id)
+
         return True
     except Exception as e:
         logger.error(f"Error starting terminal {id}: {e}")
         # Add error to output
         error_msg = f"Error starting terminal: {str(e)}"
-        terminal_outputs[id].append(error_msg)
-        socketio.emit('terminal_output', {
-            'id': id,
-            'output': error_msg + '\n',
-            'timestamp': datetime.now().isoformat()
-        })
+        store_output_line(id, error_msg)
+        # Hand the line to the green flusher; start_terminal can run on a
+        # real OS thread, which must not emit into the eventlet hub itself
+        with pending_lock:
+            pending_outputs[id].append(error_msg)
         return False
 
 # Function to stop a terminal process
@@ -178,20 +306,21 @@ def stop_terminal(id):
             
             # Try to send Ctrl+C signal to the process group
             try:
-                os.killpg(os.getpgid(process.pid), signal.SIGINT)
+                os.killpg(terminals[id]['pgid'], signal.SIGINT)
             except ProcessLookupError:
                 pass  # Process already terminated
             
-            # Wait a bit for graceful termination
-            time.sleep(1)
-            
-            # Force kill if still running
-            if process.poll() is None:
+            # Wait for graceful termination, force kill if still running
+            try:
+                process.wait(timeout=1)
+            except subprocess.TimeoutExpired:
                 try:
-                    os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+                    os.killpg(terminals[id]['pgid'], signal.SIGKILL)
                 except ProcessLookupError:
                     pass
-            
+                process.wait(timeout=1)
+
+            release_terminal_pipe(id)
             terminals[id]['running'] = False
             return True
         except Exception as e:
@@ -199,30 +328,57 @@ def stop_terminal(id):
             return False
     return False
 
+# Terminals that must be up (and past their settle delay) before each
+# terminal may start; independent chains launch concurrently
+terminal_deps = {1: [], 2: [], 3: [], 4: [1], 5: [1, 2], 6: []}
+
+# Start every terminal, honoring the dependency graph; independent
+# chains run concurrently. Blocks until all terminals have started.
+def start_terminals_concurrently():
+    ready = {id: threading.Event() for id in terminal_commands}
+    results = {}
+
+    def start_when_ready(id):
+        for dep in terminal_deps[id]:
+            ready[dep].wait()
+        success = start_terminal(id)
+        results[id] = 'started' if success else 'failed'
+        # Let the node settle before its dependents are released
+        time.sleep(terminal_commands[id].get('delay', 1))
+        ready[id].set()
+
+    threads = [threading.Thread(target=start_when_ready, args=(id,), daemon=True)
+               for id in terminal_commands]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
 # Function to automatically start all terminals
 def auto_start_terminals():
     global auto_started
     if not auto_started:
-        logger.info("Auto-starting all terminals...")
-        results = {}
-        for id in range(1, 7):
-            success = start_terminal(id)
-            results[id] = 'started' if success else 'failed'
-            time.sleep(terminal_commands[id].get('delay', 1))
         auto_started = True
+        logger.info("Auto-starting all terminals...")
+        results = start_terminals_concurrently()
         logger.info(f"Auto-start completed: {results}")
 
 # Initialize all terminals when the app starts
 for i in range(1, 7):
     terminals[i] = {'process': None, 'running': False}
 
-# Start a thread to auto-start terminals after a short delay
+# Start the single output reader thread and the batched emit flusher
+io_thread = threading.Thread(target=_io_loop, daemon=True)
+io_thread.start()
+socketio.start_background_task(_flush_outputs)
+
+# Auto-start terminals after a short delay, on the shared pool
 def delayed_auto_start():
     time.sleep(3)  # Wait for server to fully start
     auto_start_terminals()
 
-auto_start_thread = threading.Thread(target=delayed_auto_start, daemon=True)
-auto_start_thread.start()
+executor.submit(delayed_auto_start)
 
 # Route for the main page
 @app.route('/')
@@ -256,28 +412,28 @@ def api_stop_terminal(id):
 def get_terminal_output(id):
     if 1 <= id <= 6:
         # Get last 5 lines of output
-        lines = terminal_outputs[id]
-        last_five = '\n'.join(lines[-5:]) if len(lines) > 5 else '\n'.join(lines)
+        last_five = '\n'.join(terminal_tails[id])
         return jsonify({'output': last_five})
     return jsonify({'output': ''})
 
 # API endpoint to start all terminals
 @app.route('/start_all', methods=['POST'])
 def start_all():
-    results = {}
-    for id in range(1, 7):
-        success = start_terminal(id)
-        results[id] = 'started' if success else 'failed'
-        time.sleep(terminal_commands[id].get('delay', 1))
+    # The scheduler joins real OS threads, so run it on eventlet's OS
+    # thread pool to keep the hub serving while terminals come up
+    results = tpool.execute(start_terminals_concurrently)
     return jsonify({'status': 'completed', 'results': results})
 
 # API endpoint to stop all terminals
 @app.route('/stop_all', methods=['POST'])
 def stop_all():
-    results = {}
+    # Each blocking stop runs on eventlet's OS thread pool, one greenlet
+    # per terminal, so all six overlap and the hub keeps serving
+    pile = eventlet.GreenPile()
     for id in range(1, 7):
-        success = stop_terminal(id)
-        results[id] = 'stopped' if success else 'failed'
+        pile.spawn(tpool.execute, stop_terminal, id)
+    results = {id: 'stopped' if success else 'failed'
+               for id, success in zip(range(1, 7), pile)}
     return jsonify({'status': 'completed', 'results': results})
 
 # API endpoint to get terminal status
@@ -292,22 +448,28 @@ def terminal_status(id):
 # SocketIO event for connection
 @socketio.on('connect')
 def handle_connect():
+    global connected_clients
+    with clients_lock:
+        connected_clients += 1
     logger.debug('Client connected')
-    emit('connection_status', {'status': 'connected', 'timestamp': datetime.now().isoformat()})
-    
+    timestamp = datetime.now().isoformat()
+    emit('connection_status', {'status': 'connected', 'timestamp': timestamp})
+
     # Send initial terminal outputs to the newly connected client
     for id in range(1, 7):
-        lines = terminal_outputs[id]
-        last_five = '\n'.join(lines[-5:]) if len(lines) > 5 else '\n'.join(lines)
+        last_five = '\n'.join(terminal_tails[id])
         emit('terminal_output', {
             'id': id,
             'output': last_five + '\n' if last_five else '',
-            'timestamp': datetime.now().isoformat()
+            'timestamp': timestamp
         })
 
 # SocketIO event for disconnection
 @socketio.on('disconnect')
 def handle_disconnect():
+    global connected_clients
+    with clients_lock:
+        connected_clients -= 1
     logger.debug('Client disconnected')
 
 # Ping event for connection monitoring
@@ -322,4 +484,4 @@ def health_check():
 
 if __name__ == '__main__':
     logger.info("Starting Terminal Manager application...")
-    socketio.run(app, host='0.0.0.0', port=5005, debug=False, allow_unsafe_werkzeug=False)
\ No newline at end of file
+    socketio.run(app, host='0.0.0.0', port=5005, debug=False)
\ No newline at end of file